@@ -22,7 +22,7 @@ from googletrans import Translator
 import requests
 import xml.dom.minidom
 import emoji
-import requests
+import string
 
 # Specify logging level
 logging.basicConfig(level=logging.DEBUG)
@@ -37,6 +37,18 @@ noAi = False
 # Telegram Bot
 telegramBot: telebot.TeleBot
 
+# Telegram maximum message length
+TELEGRAM_MAX_LENGTH = 4096
+
+# Default message template, emoji are written as aliases
+default_template = ":Italy: {title_it}\n" + \
+                    ":United_States: {title_en}\n" + \
+                    "\n:pencil2: {author}\n" + \
+                    ":spiral_calendar: {date}\n" + \
+                    "\n:Italy: {summary_it}\n" + \
+                    "\n:United_States: {summary_en}\n" + \
+                    "\n:link: {link}"
+
 # Default feeds
 default_urls = [
                 'https://www.amsat.org/feed/',
@@ -119,12 +131,33 @@ def get_post_interval_from_env() -> int:
     """Return the publishing interval from environment variables"""
     return int(os.getenv('POST_INTERVAL', default=41))
 
+# Get how many consecutive failures open the feed circuit breaker
+def get_feed_max_failures_from_env() -> int:
+    """Return how many consecutive failures a feed can have before being skipped from environment variables"""
+    return int(os.getenv('FEED_MAX_FAILURES', default=3))
+
+# Get maximum backoff for failing feeds
+def get_feed_max_backoff_from_env() -> int:
+    """Return the maximum minutes a failing feed is skipped from environment variables"""
+    return int(os.getenv('FEED_MAX_BACKOFF', default=1440))
+
+# Get message template
+def get_message_template_from_env() -> str:
+    """Return the Telegram message template from environment variables"""
+    return os.getenv('MESSAGE_TEMPLATE', default=default_template).replace("\\n", "\n")
+
 # Bot initialization
 def init_bot():
     """Initialize the Telegram bot class"""
     global telegramBot
     telegramBot = telebot.TeleBot(get_bot_api_from_env())
 
+# Message template initialization
+def init_message_template():
+    """Compile the Telegram message template"""
+    global messageTemplate
+    messageTemplate = MessageTemplate(get_message_template_from_env(), get_target_chat_from_env())
+
 # Remove HTML code
 def remove_html(inputText: str) -> str:
     """Remove html code from the news content"""
@@ -139,6 +172,7 @@ class NewsFromFeed(list):
     author: str = ""
     summary: str = ""
     link: str = ""
+    url: str = ""
     checksum: str = ""
 
     def __init__(self, inputTitle: str, inputDate: str, inputAuthor: str, inputSummary: str, inputLink: str = "") -> None:
@@ -159,6 +193,7 @@ class NewsFromFeed(list):
             cut_text: str = no_read_more
         self.summary = cut_text.strip()
         clean_url = inputLink.strip().lower()
+        self.url = clean_url
         self.link = "[" + self.title + "](" + clean_url + ")"
         # Calculate checksum
         self.checksum = hashlib.md5(clean_url.encode('utf-8')).hexdigest()
@@ -172,29 +207,142 @@ def extract_domain(url):
         return result.group(1)
     return "anonymous"
 
+# Escape MarkdownV2 text
+def escape_markdown(inputText: str) -> str:
+    """Escape Telegram MarkdownV2 special characters"""
+    return re.sub(r'([_*\[\]()~`>#+\-=|{}.!\\])', r'\\\1', inputText)
+
+# Telegram message template
+class MessageTemplate():
+    """Precompiled Telegram message, emoji and target chat are resolved once"""
+    valid_fields = ("title", "title_it", "title_en", "author", "date", "summary", "summary_it", "summary_en", "link", "url")
+    # Fields which can be shortened when the message is too long
+    trimmable_fields = ("summary", "summary_it", "summary_en", "title", "title_it", "title_en", "link", "author")
+    compiled: str = ""
+    fields: set[str]
+    target_chat: int
+
+    def __init__(self, inputTemplate: str, targetChat: int) -> None:
+        self.target_chat = targetChat
+        self.fields = set()
+        static_length = 0
+        # Escape static text once, placeholders are filled at render time
+        for literal_text, field_name, format_spec, conversion in string.Formatter().parse(emoji.emojize(inputTemplate, language="alias")):
+            escaped_text = escape_markdown(literal_text)
+            static_length += len(escaped_text)
+            self.compiled += escaped_text.replace("{", "{{").replace("}", "}}")
+            if field_name is None:
+                continue
+            if field_name not in self.valid_fields or format_spec or conversion:
+                logging.critical("Invalid message template field [" + field_name + "]")
+                raise Exception("Invalid MESSAGE_TEMPLATE")
+            self.fields.add(field_name)
+            self.compiled += "{" + field_name + "}"
+        if static_length >= TELEGRAM_MAX_LENGTH:
+            logging.critical("Message template is too long!")
+            raise Exception("Invalid MESSAGE_TEMPLATE")
+        logging.debug("Message template uses fields: " + str(sorted(self.fields)))
+
+    def field_value(self, inputNews: NewsFromFeed, fieldName: str) -> str:
+        """Return the raw value of a template field, translations are only made when needed"""
+        if fieldName == "title" or fieldName == "link":
+            return inputNews.title
+        elif fieldName == "title_it":
+            return translate_text(inputNews.title, "it")
+        elif fieldName == "title_en":
+            return translate_text(inputNews.title, "en")
+        elif fieldName == "author":
+            return inputNews.author
+        elif fieldName == "date":
+            return inputNews.date.strftime('%Y/%m/%d, %H:%M')
+        elif fieldName == "summary":
+            return inputNews.summary
+        elif fieldName == "summary_it":
+            return translate_text(inputNews.summary, "it")
+        elif fieldName == "summary_en":
+            return translate_text(inputNews.summary, "en")
+        return inputNews.url
+
+    def format(self, rawValues: dict[str, str], inputUrl: str) -> str:
+        """Escape the field values and fill the compiled template"""
+        escaped_values = {field: escape_markdown(value) for field, value in rawValues.items()}
+        if "link" in escaped_values:
+            escaped_values["link"] = "[" + escaped_values["link"] + "](" + re.sub(r'([)\\])', r'\\\1', inputUrl) + ")"
+        return self.compiled.format(**escaped_values)
+
+    def render(self, inputNews: NewsFromFeed) -> str:
+        """Build the MarkdownV2 payload for a news, shortening it to the Telegram maximum length"""
+        raw_values = {field: self.field_value(inputNews, field) for field in self.fields}
+        telegram_payload = self.format(raw_values, inputNews.url)
+        while len(telegram_payload) > TELEGRAM_MAX_LENGTH:
+            overflow = len(telegram_payload) - TELEGRAM_MAX_LENGTH
+            # Shorten the longest field
+            trimmable = [field for field in self.trimmable_fields if field in raw_values and len(raw_values[field]) > 0]
+            if len(trimmable) < 1:
+                logging.warning("Cannot shorten message for [" + inputNews.url + "]")
+                return telegram_payload[:TELEGRAM_MAX_LENGTH]
+            longest_field = max(trimmable, key=lambda field: len(raw_values[field]))
+            if len(raw_values[longest_field]) <= overflow + 4:
+                raw_values[longest_field] = ""
+            else:
+                raw_values[longest_field] = raw_values[longest_field][:-(overflow + 4)].rstrip() + " ..."
+            telegram_payload = self.format(raw_values, inputNews.url)
+        return telegram_payload
+
+# Compiled message template
+messageTemplate: MessageTemplate
+
 # Parse RSS feed
-def parse_news(urls_list: list[str]) -> list[NewsFromFeed]:
+def parse_news(urls_list: list[str], sql_connector: sqlite3.Connection = None) -> list[NewsFromFeed]:
     """Reads the url list and returns a list of RSS contents"""
+    # Prepare list of news
+    news_list: list[NewsFromFeed] = []
     # Get feeds from the list above
-    fetch_feeds = []
     for url in urls_list:
+        # Skip feeds which are failing too often
+        if sql_connector is not None and not feed_circuit_closed(sql_connector, url):
+            logging.debug("Skipping [" + url + "], circuit breaker is open")
+            continue
         logging.debug("Retrieving feed at [" + url + "]")
+        start_time = time.monotonic()
+        feed_news: list[NewsFromFeed] = []
+        error_message: str = None
         r: requests.Response = None
         try:
             r = requests.get(url, timeout=10)
         except Exception as ret_exception:
             logging.error("Cannot download feed from [" + url + "]. Error message: " + str(ret_exception))
+            error_message = str(ret_exception)
         if r is None:
             logging.warning(f"Cannot retrieve [{url}] check network status")
-            continue
-        if r.status_code == 200:
+            if error_message is None:
+                error_message = "Cannot retrieve feed"
+        elif r.status_code == 200:
             try:
-                fetch_feeds.append(feedparser.parse(r.content)["entries"])
+                feed_entries = feedparser.parse(r.content)["entries"]
+                feed_news = parse_entries(feed_entries)
+                if len(feed_entries) < 1:
+                    error_message = "No entries in feed"
+                elif len(feed_news) < 1:
+                    error_message = "No valid entries in feed"
             except Exception as ret_exception:
                 logging.error("Cannot parse feed from [" + url + "]. Error message: " + str(ret_exception))
+                error_message = "Cannot parse feed: " + str(ret_exception)
         else:
             logging.warning("Got error code [" + str(r.status_code) + "] while retrieving content at [" + url + "]")
-    feeds_list = [item for feed in fetch_feeds for item in feed]
+            error_message = "Got error code [" + str(r.status_code) + "]"
+        # Store feed statistics
+        if sql_connector is not None:
+            update_feed_health(sql_connector, url, time.monotonic() - start_time, len(feed_news), error_message)
+        news_list.extend(feed_news)
+    # Return list
+    logging.info("Fetch [" + str(len(news_list)) + "] news")
+    news_list.sort(key=lambda news: news.date, reverse=True)
+    return news_list
+
+# Convert RSS entries to news
+def parse_entries(feeds_list: list) -> list[NewsFromFeed]:
+    """Converts the entries of a single RSS feed to a list of news"""
     # Prepare list of news
     news_list: list[NewsFromFeed] = []
     # Scan each feed and convert it to a class element. Store the checksum to avoid dupes
@@ -237,9 +385,6 @@ def parse_news(urls_list: list[str]) -> list[NewsFromFeed]:
             # Unknown format
             logging.warning("Skipping [" + single_feed["link"] + "], incompatible RSS format")
             continue
-    # Return list
-    logging.info("Fetch [" + str(len(news_list)) + "] news")
-    news_list.sort(key=lambda news: news.date, reverse=True)
     return news_list
 
 # Handle translation
@@ -292,6 +437,12 @@ def prepare_db() -> None:
         logging.info("Feeds table was generated successfully")
     except:
         logging.debug("Feeds table already exists")
+    # Create feeds health table
+    try:
+        sqliteCursor.execute("CREATE TABLE feed_health(url PRIMARY KEY, consecutive_failures DEFAULT 0, last_success, last_error, next_attempt, avg_latency DEFAULT 0, avg_entries DEFAULT 0, fetch_count DEFAULT 0, success_count DEFAULT 0)")
+        logging.info("Feed health table was generated successfully")
+    except:
+        logging.debug("Feed health table already exists")
     # Get feeds from DB
     data_from_db = sqliteCursor.execute("SELECT url FROM feeds WHERE 1").fetchall()
     if (len(data_from_db) < 1):
@@ -317,6 +468,51 @@ def get_sql_connector() -> sqlite3.Connection:
     """Connect to sqlite"""
     return sqlite3.connect("store/frlbot.db", timeout=3)
 
+# Check feed circuit breaker
+def feed_circuit_closed(sql_connector: sqlite3.Connection, url: str) -> bool:
+    """Check if a feed should be fetched, failing feeds are skipped until their backoff expires"""
+    health_row = sql_connector.cursor().execute("SELECT next_attempt FROM feed_health WHERE url=?", [url]).fetchone()
+    if health_row is None or health_row[0] is None:
+        return True
+    return datetime.now() >= datetime.fromisoformat(health_row[0])
+
+# Update feed statistics
+def update_feed_health(sql_connector: sqlite3.Connection, url: str, latency: float, entries_cnt: int, error_message: str = None) -> None:
+    """Store the outcome of a feed fetch and open the circuit breaker after repeated failures"""
+    try:
+        sql_connector.execute("INSERT OR IGNORE INTO feed_health(url) VALUES(?)", [url])
+        health_row = sql_connector.cursor().execute("SELECT consecutive_failures, avg_latency, avg_entries, fetch_count, success_count FROM feed_health WHERE url=?", [url]).fetchone()
+        consecutive_failures, avg_latency, avg_entries, fetch_count, success_count = health_row
+        # Update running averages
+        fetch_count += 1
+        avg_latency += (latency - avg_latency) / fetch_count
+        now_str = datetime.now().isoformat(sep=" ", timespec="seconds")
+        if error_message is None:
+            success_count += 1
+            avg_entries += (entries_cnt - avg_entries) / success_count
+            sql_connector.execute("UPDATE feed_health SET consecutive_failures=0, last_success=?, next_attempt=NULL, avg_latency=?, avg_entries=?, fetch_count=?, success_count=? WHERE url=?",
+                                  [now_str, avg_latency, avg_entries, fetch_count, success_count, url])
+        else:
+            consecutive_failures += 1
+            next_attempt = None
+            max_failures = get_feed_max_failures_from_env()
+            # Exponential backoff once the circuit is open
+            if consecutive_failures >= max_failures:
+                backoff_minutes = min(get_post_interval_from_env() * 2 ** (consecutive_failures - max_failures), get_feed_max_backoff_from_env())
+                next_attempt = (datetime.now() + timedelta(minutes=backoff_minutes)).isoformat(sep=" ", timespec="seconds")
+                logging.warning("Feed [" + url + "] failed [" + str(consecutive_failures) + "] times in a row, next attempt at [" + next_attempt + "]")
+            sql_connector.execute("UPDATE feed_health SET consecutive_failures=?, last_error=?, next_attempt=?, avg_latency=?, fetch_count=? WHERE url=?",
+                                  [consecutive_failures, now_str + ": " + error_message, next_attempt, avg_latency, fetch_count, url])
+        sql_connector.commit()
+    except Exception as returned_exception:
+        logging.error("Cannot update health of [" + url + "]. " + str(returned_exception))
+
+# Remove statistics of deleted feeds
+def remove_orphan_feed_health(sql_connector: sqlite3.Connection) -> None:
+    """Delete health records of feeds which are no longer in the feeds table"""
+    sql_connector.execute("DELETE FROM feed_health WHERE url NOT IN (SELECT url FROM feeds)")
+    sql_connector.commit()
+
 # Delete old SQLite records
 def remove_old_news(max_days: int = -1) -> int:
     """Delete all old feeds from the database"""
@@ -357,7 +553,7 @@ def main():
     exception_cnt = 0
     exception_message = ""
     # Get news from feed
-    for single_news in parse_news(feeds_from_db):
+    for single_news in parse_news(feeds_from_db, sql_connector):
         # Check if we already sent this message
         if sql_connector.cursor().execute("SELECT * FROM news WHERE checksum='" + single_news.checksum + "'").fetchone() is None:
             logging.info("Sending: [" + single_news.link + "]")
@@ -367,22 +563,11 @@ def main():
             elif single_news.date.replace(tzinfo=None) > datetime.now().replace(tzinfo=None):
                 logging.warning("Article: [" + single_news.link + "] is coming from the future?!")
             else:
-                # Prepare message to send
-                emoji_flag_it = emoji.emojize(":Italy:", language="alias")
-                emoji_flag_en = emoji.emojize(":United_States:", language="alias")
-                emoji_pencil = emoji.emojize(":pencil2:", language="alias")
-                emoji_calendar = emoji.emojize(":spiral_calendar:", language="alias")
-                emoji_link = emoji.emojize(":link:", language="alias")
                 try:
-                    telegram_payload = f"{emoji_flag_it} {translate_text(single_news.title, 'it')}\n" + \
-                                        f"{emoji_flag_en} {translate_text(single_news.title, 'en')}\n" + \
-                                        f"\n{emoji_pencil} {single_news.author}\n" + \
-                                        f"{emoji_calendar} {single_news.date.strftime('%Y/%m/%d, %H:%M')}\n" + \
-                                        f"\n{emoji_flag_it} {translate_text(single_news.summary, 'it')}\n" + \
-                                        f"\n{emoji_flag_en} {translate_text(single_news.summary, 'en')}\n" + \
-                                        f"\n{emoji_link} {single_news.link}"
+                    # Prepare message to send
+                    telegram_payload = messageTemplate.render(single_news)
                     if not dryRun:
-                        telegramBot.send_message(get_target_chat_from_env(), telegram_payload, parse_mode="MARKDOWN")
+                        telegramBot.send_message(messageTemplate.target_chat, telegram_payload, parse_mode="MarkdownV2")
                     else:
                         logging.info(telegram_payload)
                     if not dryRun:
@@ -546,6 +731,7 @@ if __name__ == "__main__":
                         try:
                             sqlCon.execute("DELETE FROM feeds WHERE rowid=?", [splitText[1]])
                             sqlCon.commit()
+                            remove_orphan_feed_health(sqlCon)
                             sqlCon.close()
                             telegramBot.reply_to(inputMessage, "Element was removed successfully!")
                         except Exception as retExc:
@@ -660,12 +846,45 @@ if __name__ == "__main__":
                             sqlCon.execute("DELETE FROM feeds WHERE rowid=?", [singleElement[0]])
                             sqlCon.commit()
                             invalidsCnt += 1
+                # Remove statistics of deleted feeds
+                remove_orphan_feed_health(sqlCon)
                 # Close DB connection
                 sqlCon.close()
                 # Return output
                 telegramBot.reply_to(inputMessage, "Removed [" + str(invalidsCnt) + "] invalid and [" + str(duplicatesCnt) + "] duplicated RSS feeds")
             else:
                 logging.debug("Ignoring message from [" + str(inputMessage.from_user.id) + "]")
+        # Show feeds health
+        @telegramBot.message_handler(content_types=["text"], commands=['feedhealth'])
+        def HandleFeedHealth(inputMessage: telebot.types.Message):
+            if inputMessage.from_user.id == get_admin_chat_from_env():
+                logging.debug("Feed health requested from [" + str(inputMessage.from_user.id) + "]")
+                global telegramBot
+                sqlCon = get_sql_connector()
+                failingFeeds = sqlCon.cursor().execute("SELECT url, consecutive_failures, next_attempt, last_success, last_error FROM feed_health WHERE consecutive_failures > 0 ORDER BY consecutive_failures DESC").fetchall()
+                slowestFeeds = sqlCon.cursor().execute("SELECT url, avg_latency, avg_entries FROM feed_health WHERE fetch_count > 0 ORDER BY avg_latency DESC LIMIT 10").fetchall()
+                sqlCon.close()
+                if len(failingFeeds) < 1 and len(slowestFeeds) < 1:
+                    telegramBot.reply_to(inputMessage, "No statistics in the feed health table")
+                    return
+                healthLines: list[str] = ["Failing feeds: [" + str(len(failingFeeds)) + "]"]
+                for singleElement in failingFeeds:
+                    healthLines.append("[" + str(singleElement[1]) + "] failures - " + singleElement[0] + "\n" +
+                                       "  Next attempt: " + str(singleElement[2] or "next run") + " - Last success: " + str(singleElement[3] or "never") + "\n" +
+                                       "  Last error: " + str(singleElement[4]))
+                healthLines.append("\nSlowest feeds:")
+                for singleElement in slowestFeeds:
+                    healthLines.append("[" + "{:.2f}".format(singleElement[1]) + "s, " + "{:.1f}".format(singleElement[2]) + " entries] - " + singleElement[0])
+                textMessage: str = ""
+                for singleLine in healthLines:
+                    # Check if message is longer than max length
+                    if len(textMessage) + len(singleLine) + 10 >= 4096:
+                        telegramBot.send_message(inputMessage.from_user.id, textMessage)
+                        textMessage = ""
+                    textMessage += singleLine[:4000] + "\n"
+                telegramBot.send_message(inputMessage.from_user.id, textMessage)
+            else:
+                logging.debug("Ignoring message from [" + str(inputMessage.from_user.id) + "]")
         # Perform DB backup
         @telegramBot.message_handler(content_types=["text"], commands=['sqlitebackup'])
         def HandleSqliteBackup(inputMessage: telebot.types.Message):
@@ -682,6 +901,8 @@ if __name__ == "__main__":
                     telegramBot.reply_to(inputMessage, "Error: " + str(retExc))
             else:
                 logging.debug("Ignoring message from [" + str(inputMessage.from_user.id) + "]")
+    # Compile message template
+    init_message_template()
     # Prepare DB object
     prepare_db()
     if forceRun: